@@ -1,7 +1,8 @@
 # conda activate gis_env
 
 ### IMPORTS
-import requests, zipfile, io, re, datetime, os, shutil, tempfile
+import requests, zipfile, io, datetime, os, shutil, tempfile
+from concurrent.futures import ThreadPoolExecutor
 import xml.etree.ElementTree as ET
 from arcgis.gis import GIS
 from dotenv import load_dotenv, set_key, find_dotenv
@@ -9,6 +10,7 @@ from dotenv import load_dotenv, set_key, find_dotenv
 from simple_arcgis_online_functions import overwrite_featurelayer_collection
 
 ### CONSTANTS
+ATOM_NAMESPACE = '{http://www.w3.org/2005/Atom}'
 
 ### FUNCTIONS
 def authenticate():
@@ -37,24 +39,73 @@ def __download_water_protection_areas(extract_path: str = "/arcgis/home/data/AwF
     file_list = [os.path.join(extract_path, file_name) for file_name in file_list]
     return  file_list
 
-def download_and_extract_xml(metadata_url: str ='https://geoportal.bafg.de/inspire/download/AM/waterProtectionArea/datasetfeed.xml') -> list[dict]:
-    response = requests.get(metadata_url)
-    xml_data = response.text
+def _parse_feed_timestamp(value: str) -> datetime.datetime | None:
+    """Parse an atom timestamp like '2023-10-06T08:00:00+01:00' incl. its timezone, returns None if it cannot be parsed"""
+    try:
+        timestamp = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except (AttributeError, ValueError):
+        return None
+    if(timestamp.tzinfo == None):
+        timestamp = timestamp.replace(tzinfo=datetime.timezone.utc) # atom requires an offset, assume UTC if it is missing
+    return timestamp
+
+def read_feed_entries(metadata_url: str, max_entries: int = None) -> list[dict]:
+    """Read the entries of an atom feed (e.g. an INSPIRE dataset or service feed) while it is downloaded
+
+    Arguments:
+        metadata_url {str} -- the url of the atom feed
+
+    Keyword Arguments:
+        max_entries {int} -- stop reading after this many entries (default: {None} = all entries)
 
-    root = ET.fromstring(xml_data)
-    namespace = {'atom': '{http://www.w3.org/2005/Atom}'}
+    Returns:
+        list[dict] -- one dict {tag: text} per entry, 'updated' is a timezone aware datetime
+                      (timestamps without offset are read as UTC) or None if it cannot be parsed
+    """
     entries = []
-    for element in root:
-        element.tag.replace(namespace['atom'], '')
-        if(element.tag.replace(namespace['atom'], '') == 'entry'):
-            data_dict_entry = {child.tag.replace(namespace['atom'], ''): child.text for child in element}
-
-            #if the value matches this timestamp format: '2023-10-06T08:00:00+01:00', convert it to a datetime object use regex to match that format
-            if(re.match(r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}', data_dict_entry['updated'])):
-                data_dict_entry['updated'] = datetime.datetime.strptime(data_dict_entry['updated'][:-6], '%Y-%m-%dT%H:%M:%S') # neglect the timezone for now
+    with requests.get(metadata_url, stream=True) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        root = None
+        for event, element in ET.iterparse(response.raw, events=('start', 'end')):
+            if(root is None):
+                root = element
+            if(event != 'end' or element.tag != f'{ATOM_NAMESPACE}entry'):
+                continue
+            data_dict_entry = {child.tag.replace(ATOM_NAMESPACE, ''): child.text for child in element}
+            if('updated' in data_dict_entry):
+                data_dict_entry['updated'] = _parse_feed_timestamp(data_dict_entry['updated'])
             entries.append(data_dict_entry)
+            root.clear() # free the parsed entries
+            if(max_entries is not None and len(entries) >= max_entries):
+                break
     return entries
 
+def read_feeds(metadata_urls: list[str], max_entries: int = None, max_workers: int = 8) -> dict[str, list[dict] | Exception]:
+    """Read several atom feeds concurrently
+
+    Arguments:
+        metadata_urls {list[str]} -- the urls of the atom feeds
+
+    Keyword Arguments:
+        max_entries {int} -- stop reading each feed after this many entries (default: {None} = all entries)
+        max_workers {int} -- the number of feeds read in parallel (default: {8})
+
+    Returns:
+        dict[str, list[dict] | Exception] -- the entries per url, or the exception if a feed could not be read
+    """
+    def read(metadata_url):
+        try:
+            return read_feed_entries(metadata_url, max_entries)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(metadata_urls, executor.map(read, metadata_urls)))
+
+def download_and_extract_xml(metadata_url: str ='https://geoportal.bafg.de/inspire/download/AM/waterProtectionArea/datasetfeed.xml', max_entries: int = None) -> list[dict]:
+    return read_feed_entries(metadata_url, max_entries)
+
 def download_zip_file_from_url(url:str) -> str:
     """
     Download a zip file from an url and return the path to the downloaded file
@@ -87,10 +138,15 @@ def main_check_and_update_waterprotection_areas(item_id:str = '4c669b6afdf046b08
         load_dotenv()
         water_protection_last_publish_date = datetime.datetime.fromisoformat(os.getenv('WATER_PROTECTION_LAST_PUBLISH_DATE')) if os.getenv('WATER_PROTECTION_LAST_PUBLISH_DATE') else None
 
-        # 2) Get the current publish date
+        # 2) Get the current publish date (only the first entry is needed)
         water_protection_metadata_url = 'https://geoportal.bafg.de/inspire/download/AM/waterProtectionArea/datasetfeed.xml'
-        data_entries = download_and_extract_xml(water_protection_metadata_url)
-        water_protection_current_publish_date = data_entries[0]['updated']
+        data_entries = download_and_extract_xml(water_protection_metadata_url, max_entries=1)
+        water_protection_current_publish_date = data_entries[0].get('updated')
+        if(water_protection_current_publish_date == None):
+            raise ValueError(f'The feed {water_protection_metadata_url} has no valid updated timestamp')
+        if(water_protection_last_publish_date != None and water_protection_last_publish_date.tzinfo == None):
+            # dates stored by older versions have no timezone, they were stored in the timezone of the feed
+            water_protection_last_publish_date = water_protection_last_publish_date.replace(tzinfo=water_protection_current_publish_date.tzinfo)
         
         # 3) Compare the dates
         if((water_protection_last_publish_date == None) or (water_protection_current_publish_date >= water_protection_last_publish_date)):
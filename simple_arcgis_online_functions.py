@@ -1,9 +1,10 @@
 from enum import Enum
-import secrets, os
+import secrets, os, shutil, json, hashlib, threading, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
 from arcgis.gis import GIS
-from arcgis.features import FeatureLayerCollection
+from arcgis.features import FeatureLayerCollection, FeatureLayer
 from dotenv import load_dotenv
 
 
@@ -11,6 +12,8 @@ from dotenv import load_dotenv
 load_dotenv()
 EXAMPLE1 = True
 EXAMPLE2 = True
+LAYER_CACHE_DIR = os.getenv('AGOL_LAYER_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'arcgis-python-api'))
+LAYER_CACHE_TTL = 3600 # seconds
 
 
 ### HELPER CLASSES
@@ -24,6 +27,175 @@ class FileFormats(Enum):
         self.extension = extension
 
 
+class LayerResolver:
+    """
+    Resolves (item_id, layer_name) to the layer url and layer definition.
+    The definitions of all layers of a service are fetched with one request (<service url>/layers)
+    and kept in memory and in a json file on disk (one file per portal and user). After ttl seconds
+    the lastEditDate of the service is checked and the definitions are only fetched again if the
+    service has changed. Changes within the ttl are not noticed, helpers that change a service
+    definition have to call invalidate().
+    """
+    def __init__(self, gis_portal: GIS, cache_dir: str = LAYER_CACHE_DIR, ttl: int = LAYER_CACHE_TTL, max_workers: int = 8):
+        self.gis_portal = gis_portal
+        self.portal_key = _portal_key(gis_portal)
+        self.cache_path = None
+        if(cache_dir != None):
+            file_name = hashlib.sha1('|'.join(self.portal_key).encode('utf-8')).hexdigest()[:16]
+            self.cache_path = os.path.join(cache_dir, f'layers_{file_name}.json')
+        self.ttl = ttl
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._invalidated = ({}, {}) # item_ids and layer_urls dropped since the last save -> time of the invalidation
+        # item_id -> {'url', 'lastEditDate', 'fetched', 'layers': {name: layer_url}} and layer_url -> {'definition', 'fetched'}
+        self._services, self._layers = self._read_cache()
+
+    def _read_cache(self) -> tuple[dict, dict]:
+        if(self.cache_path == None or not os.path.isfile(self.cache_path)):
+            return {}, {}
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+            if(cache.get('portal') != list(self.portal_key)):
+                return {}, {}
+            return cache.get('services', {}), cache.get('layers', {})
+        except (OSError, ValueError) as e:
+            print(e)
+            return {}, {}
+
+    def _save_cache(self):
+        """Merge the in-memory cache with the file on disk (entries of other processes are kept) and write it back, call with self._lock held"""
+        if(self.cache_path == None):
+            return
+        try:
+            services, layers = self._read_cache()
+            for cached, entries, invalidated in ((services, self._services, self._invalidated[0]), (layers, self._layers, self._invalidated[1])):
+                for key, invalidated_at in invalidated.items():
+                    if(key in cached and cached[key]['fetched'] <= invalidated_at):
+                        del cached[key]
+                for key, entry in entries.items():
+                    if(key not in cached or cached[key]['fetched'] <= entry['fetched']):
+                        cached[key] = entry
+                entries.update(cached)
+                invalidated.clear()
+            os.makedirs(os.path.dirname(self.cache_path), mode=0o700, exist_ok=True)
+            temp_path = f'{self.cache_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w', encoding='utf-8') as f:
+                json.dump({'portal': list(self.portal_key), 'services': services, 'layers': layers}, f)
+            os.replace(temp_path, self.cache_path)
+        except OSError as e:
+            print(e)
+
+    def _service_definition(self, service_url: str) -> dict:
+        return self.gis_portal._con.get(service_url, {'f': 'json'})
+
+    def _is_fresh(self, item_id: str) -> tuple[bool, dict | None]:
+        """Return whether the cached service is still valid and the service definition if it had to be requested"""
+        service = self._services.get(item_id)
+        if(service == None):
+            return False, None
+        if(time.time() - service['fetched'] < self.ttl):
+            return True, None
+        if(service['lastEditDate'] == None):
+            return False, None
+        service_definition = self._service_definition(service['url'])
+        if(service_definition.get('editingInfo', {}).get('lastEditDate') == service['lastEditDate']):
+            with self._lock:
+                service['fetched'] = time.time()
+                for layer_url in service['layers'].values():
+                    if(layer_url in self._layers):
+                        self._layers[layer_url]['fetched'] = service['fetched']
+            return True, service_definition
+        return False, service_definition
+
+    def _fetch_service(self, item_id: str, service_definition: dict = None):
+        service = self._services.get(item_id)
+        service_url = service['url'] if service else self.gis_portal.content.get(item_id).url
+        if(service_definition == None):
+            service_definition = self._service_definition(service_url)
+        last_edit_date = service_definition.get('editingInfo', {}).get('lastEditDate')
+        definitions = self.gis_portal._con.get(f'{service_url}/layers', {'f': 'json'})
+        fetched = time.time()
+        layers = {}
+        with self._lock:
+            for definition in definitions.get('layers', []) + definitions.get('tables', []):
+                layer_url = f"{service_url}/{definition['id']}"
+                layers[definition['name']] = layer_url
+                self._layers[layer_url] = {'definition': definition, 'fetched': fetched}
+            self._services[item_id] = {'url': service_url, 'lastEditDate': last_edit_date, 'fetched': fetched, 'layers': layers}
+
+    def prefetch(self, item_ids: list[str]):
+        """Fetch the layer definitions of all given items in parallel, items that are still cached are skipped"""
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self._resolve_service, item_id, False) for item_id in set(item_ids)]
+            for future in as_completed(futures):
+                future.result()
+        with self._lock:
+            self._save_cache()
+
+    def _resolve_service(self, item_id: str, save: bool = True) -> dict:
+        fresh, service_definition = self._is_fresh(item_id)
+        if(not fresh):
+            self._fetch_service(item_id, service_definition)
+            if(save):
+                with self._lock:
+                    self._save_cache()
+        return self._services[item_id]
+
+    def get_layer_url(self, item_id: str, layer_name: str) -> str:
+        """Return the url of the layer (or table) named layer_name of the item"""
+        layers = self._resolve_service(item_id)['layers']
+        if(layer_name not in layers):
+            raise KeyError(f'The item {item_id} has no layer named {layer_name}')
+        return layers[layer_name]
+
+    def get_definition(self, item_id: str = None, layer_name: str = None, layer_url: str = None) -> dict:
+        """Return the layer definition for either a) item_id and layer_name or b) a layer_url"""
+        if(layer_url == None):
+            layer_url = self.get_layer_url(item_id, layer_name)
+        item_id = next((item_id for item_id, service in list(self._services.items()) if layer_url in service['layers'].values()), None)
+        if(item_id != None):
+            self._resolve_service(item_id)
+        layer = self._layers.get(layer_url)
+        if(layer == None or time.time() - layer['fetched'] >= self.ttl):
+            # a layer that is not part of a resolved item, cache only its own definition
+            definition = self.gis_portal._con.get(layer_url, {'f': 'json'})
+            with self._lock:
+                layer = self._layers[layer_url] = {'definition': definition, 'fetched': time.time()}
+                self._save_cache()
+        return layer['definition']
+
+    def get_feature_layer(self, item_id: str, layer_name: str) -> FeatureLayer:
+        """Return the FeatureLayer named layer_name of the item"""
+        return FeatureLayer(self.get_layer_url(item_id, layer_name), self.gis_portal)
+
+    def invalidate(self, item_id: str = None, layer_url: str = None):
+        """Drop the cached definitions of one item, of one layer (layer_url) or of all items if both are None"""
+        invalidated_at = time.time()
+        with self._lock:
+            if(item_id == None and layer_url == None):
+                self._invalidated[0].update(dict.fromkeys(self._services, invalidated_at))
+                self._invalidated[1].update(dict.fromkeys(self._layers, invalidated_at))
+                services, layers = self._read_cache()
+                self._invalidated[0].update(dict.fromkeys(services, invalidated_at))
+                self._invalidated[1].update(dict.fromkeys(layers, invalidated_at))
+                self._services.clear()
+                self._layers.clear()
+            if(item_id != None):
+                service = self._services.pop(item_id, None) or self._read_cache()[0].get(item_id)
+                self._invalidated[0][item_id] = invalidated_at
+                for url in (service['layers'].values() if service else []):
+                    self._layers.pop(url, None)
+                    self._invalidated[1][url] = invalidated_at
+            if(layer_url != None):
+                self._layers.pop(layer_url, None)
+                self._invalidated[1][layer_url] = invalidated_at
+            self._save_cache()
+
+_layer_resolvers = {} # (portal url, username) -> LayerResolver
+_layer_resolvers_lock = threading.Lock()
+
+
 ### FUNCTIONS
 def authenticate():
     user = os.environ['AGOL_USERNAME']
@@ -32,6 +204,36 @@ def authenticate():
     gis = GIS(username=user, password=pw, url=url)
     return(gis)
 
+def _portal_key(gis_portal: GIS) -> tuple[str, str]:
+    """Identify a gis portal by its url and the logged in user"""
+    return (gis_portal.url.rstrip('/').lower(), getattr(gis_portal, '_username', None) or '')
+
+def get_layer_resolver(gis_portal: GIS = None) -> LayerResolver:
+    """
+    Return the LayerResolver shared by all helpers for this gis portal
+    Keyword Arguments:
+        gis_portal {GIS} -- the gis portal to connect to (default: {None} = authenticate())
+    Returns:
+        LayerResolver -- the shared layer resolver
+    """
+    with _layer_resolvers_lock:
+        if(gis_portal == None):
+            if(None not in _layer_resolvers):
+                _layer_resolvers[None] = _layer_resolver_for(authenticate())
+            return _layer_resolvers[None]
+        return _layer_resolver_for(gis_portal)
+
+def _layer_resolver_for(gis_portal: GIS) -> LayerResolver:
+    """Return the resolver of the portal and user of gis_portal, call with _layer_resolvers_lock held"""
+    key = _portal_key(gis_portal)
+    if(key not in _layer_resolvers):
+        _layer_resolvers[key] = LayerResolver(gis_portal)
+    return _layer_resolvers[key]
+
+def get_layer_definition(feature_layer: FeatureLayer) -> dict:
+    """Return the (cached) layer definition of a feature layer"""
+    return get_layer_resolver(feature_layer._gis).get_definition(layer_url=feature_layer.url)
+
 def overwrite_featurelayer_collection(item_id:str, new_file_path:str, gis_portal: GIS = None) -> bool:
     """
     Overwrite a feature layer with a new file, the file must be of the same format as the original file
@@ -54,6 +256,9 @@ def overwrite_featurelayer_collection(item_id:str, new_file_path:str, gis_portal
         item = gis_portal.content.get(item_id)
         feature_layer_collection = FeatureLayerCollection.fromitem(item)
         result = feature_layer_collection.manager.overwrite(new_file_path)
+        if(result['success']):
+            # layer ids, names and fields may have changed
+            get_layer_resolver(gis_portal).invalidate(item_id)
         return result['success']
     except Exception as e:
         print(e) #str(e) == 'Job failed.'
@@ -95,6 +300,146 @@ def download_feature_layer_collection_from_agol(item_id:str,
         print(e)
         return False
 
+def _object_id_ranges(feature_layer:FeatureLayer, batch_size:int) -> list[tuple[int, int]]:
+    """Split the object ids of a feature layer into (min, max) ranges of at most batch_size ids"""
+    object_ids = sorted(feature_layer.query(return_ids_only=True)['objectIds'] or [])
+    return [(object_ids[i], object_ids[min(i + batch_size, len(object_ids)) - 1]) for i in range(0, len(object_ids), batch_size)]
+
+def list_attachments(feature_layer:FeatureLayer, batch_size:int=1000) -> list[dict]:
+    """
+    List the attachment metadata of all features of a feature layer
+    Arguments:
+        feature_layer {FeatureLayer} -- a feature layer with hasAttachments = True
+    Keyword Arguments:
+        batch_size {int} -- the number of features per queryAttachments request (default: {1000})
+    Returns:
+        list[dict] -- one dict per attachment with the keys PARENTOBJECTID, ID, NAME, CONTENTTYPE and SIZE
+    """
+    oid_field = get_layer_definition(feature_layer).get('objectIdField', 'OBJECTID')
+    attachments = []
+    for min_oid, max_oid in _object_id_ranges(feature_layer, batch_size):
+        where = f"{oid_field} >= {min_oid} AND {oid_field} <= {max_oid}"
+        attachments.extend(feature_layer.attachments.search(where=where))
+    return attachments
+
+def _attachment_folder(outpath:str, attachment:dict) -> str:
+    return os.path.join(outpath, str(attachment['PARENTOBJECTID']), str(attachment['ID']))
+
+def _download_attachment(feature_layer:FeatureLayer, attachment:dict, outpath:str) -> str | None:
+    """Download one attachment to outpath/<objectid>/<attachment id>/<name>, skips it if it is already complete"""
+    folder = _attachment_folder(outpath, attachment)
+    file_path = os.path.join(folder, attachment['NAME'])
+    if(os.path.isfile(file_path) and os.path.getsize(file_path) == attachment['SIZE']):
+        return None
+    os.makedirs(folder, exist_ok=True)
+    # download to a temp folder first, an interrupted run never leaves a file with the final name behind
+    part_folder = folder + '.part'
+    shutil.rmtree(part_folder, ignore_errors=True)
+    os.makedirs(part_folder)
+    downloaded = feature_layer.attachments.download(oid=attachment['PARENTOBJECTID'], attachment_id=attachment['ID'], save_path=part_folder)
+    os.replace(downloaded[0], file_path)
+    os.rmdir(part_folder)
+    return file_path
+
+def download_attachments(feature_layer:FeatureLayer, outpath:str, max_workers:int=8, batch_size:int=1000) -> dict | bool:
+    """
+    Download all attachments of a feature layer, e.g. to backup or migrate them
+    Arguments:
+        feature_layer {FeatureLayer} -- a feature layer with hasAttachments = True
+        outpath {str} -- the folder to save the attachments to, as outpath/<objectid>/<attachment id>/<name>
+    Keyword Arguments:
+        max_workers {int} -- the number of parallel downloads (default: {8})
+        batch_size {int} -- the number of features per queryAttachments request (default: {1000})
+    Returns:
+        dict -- {'downloaded': list of file paths, 'skipped': number of attachments already on disk, 'failed': list of (objectid, attachment id)}
+        bool -- False if the attachments could not be listed
+
+    Notes:
+        1. attachments whose file already exists with the same attachment id and size are skipped,
+           so an interrupted run can simply be started again to resume it
+    """
+    try:
+        attachments = list_attachments(feature_layer, batch_size)
+    except Exception as e:
+        print(e)
+        return False
+
+    result = {'downloaded': [], 'skipped': 0, 'failed': []}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_download_attachment, feature_layer, attachment, outpath): attachment for attachment in attachments}
+        for future in as_completed(futures):
+            attachment = futures[future]
+            try:
+                file_path = future.result()
+                if(file_path is None):
+                    result['skipped'] += 1
+                else:
+                    result['downloaded'].append(file_path)
+            except Exception as e:
+                print(e)
+                result['failed'].append((attachment['PARENTOBJECTID'], attachment['ID']))
+    return result
+
+def upload_attachments(feature_layer:FeatureLayer, inpath:str, object_id_map:dict[int, int]=None, max_workers:int=8, batch_size:int=1000) -> dict | bool:
+    """
+    Upload attachments from a folder created by download_attachments to a feature layer
+    Arguments:
+        feature_layer {FeatureLayer} -- the target feature layer with hasAttachments = True
+        inpath {str} -- the folder with the attachments as inpath/<objectid>/<attachment id>/<name>
+    Keyword Arguments:
+        object_id_map {dict[int, int]} -- maps the source object ids to the object ids of the target layer (default: {None} = same ids)
+        max_workers {int} -- the number of parallel uploads (default: {8})
+        batch_size {int} -- the number of features per queryAttachments request (default: {1000})
+    Returns:
+        dict -- {'uploaded': list of file paths, 'skipped': number of attachments already on the layer, 'failed': list of file paths}
+        bool -- False if the existing attachments could not be listed
+
+    Notes:
+        1. files that already exist on the target feature with the same name and size are skipped,
+           so an interrupted run can simply be started again to resume it
+    """
+    try:
+        existing = {(a['PARENTOBJECTID'], a['NAME'], a['SIZE']) for a in list_attachments(feature_layer, batch_size)}
+    except Exception as e:
+        print(e)
+        return False
+
+    uploads = []
+    for oid_folder in os.listdir(inpath):
+        if(not oid_folder.isdigit() or not os.path.isdir(os.path.join(inpath, oid_folder))):
+            continue
+        oid = int(oid_folder)
+        target_oid = object_id_map.get(oid) if object_id_map else oid
+        for attachment_folder in os.listdir(os.path.join(inpath, oid_folder)):
+            folder = os.path.join(inpath, oid_folder, attachment_folder)
+            if(attachment_folder.endswith('.part') or not os.path.isdir(folder)):
+                continue
+            for file_name in os.listdir(folder):
+                uploads.append((target_oid, os.path.join(folder, file_name)))
+
+    result = {'uploaded': [], 'skipped': 0, 'failed': []}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for target_oid, file_path in uploads:
+            if(target_oid is None):
+                result['failed'].append(file_path)
+            elif((target_oid, os.path.basename(file_path), os.path.getsize(file_path)) in existing):
+                result['skipped'] += 1
+            else:
+                futures[executor.submit(feature_layer.attachments.add, target_oid, file_path)] = file_path
+        for future in as_completed(futures):
+            file_path = futures[future]
+            try:
+                add_result = future.result()
+                if(add_result['addAttachmentResult']['success']):
+                    result['uploaded'].append(file_path)
+                else:
+                    result['failed'].append(file_path)
+            except Exception as e:
+                print(e)
+                result['failed'].append(file_path)
+    return result
+
 ### MAIN
 if __name__ == "__main__":
 
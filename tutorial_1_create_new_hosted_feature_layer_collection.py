@@ -5,7 +5,7 @@
 from arcgis.gis import GIS, Item
 from arcgis.features import FeatureLayerCollection, FeatureLayer
 
-from simple_arcgis_online_functions import authenticate
+from simple_arcgis_online_functions import authenticate, get_layer_resolver, get_layer_definition
 
 ### CONSTANTS
 EXAMPLE1 = False
@@ -198,6 +198,8 @@ def enable_editing_on_feature_layer_collection(gis_portal: GIS, item_id:str) ->
         results = feature_layer.manager.update_definition(
             {"capabilities": "Query, Extract, Editing, Create, Delete, Update"}
         )
+        if(results['success']):
+            get_layer_resolver(gis_portal).invalidate(item_id)
         return(results['success'])
     except Exception as e:
         print(e)
@@ -228,7 +230,127 @@ def add_features_to_feature_layer(feature_layer:FeatureLayer):
         print(e)
         return False
 
-def get_feature_layer(item_id:str=None, layer_name:str=None, layer_url:str=None) -> FeatureLayer | bool:
+def _sql_literal(value) -> str:
+    """Format a python value as a literal for a where clause"""
+    if(value is None):
+        return 'NULL'
+    if(isinstance(value, bool)):
+        return str(int(value))
+    if(isinstance(value, (int, float))):
+        return str(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+def _calc_expression(attributes:dict) -> list[dict]:
+    """Build the calcExpression of FeatureLayer.calculate for a dict of {field: new_value}"""
+    expressions = []
+    for field, value in attributes.items():
+        if(value is None):
+            expressions.append({"field": field, "sqlExpression": "NULL"})
+        else:
+            expressions.append({"field": field, "value": value})
+    return expressions
+
+def bulk_update_attributes(feature_layer:FeatureLayer, updates:dict, key_field:str=None, batch_size:int=500, use_calculate:bool=True) -> dict | bool:
+    """
+    Update the attributes of many features without sending their geometries.
+    Rows that receive the same new values are grouped into where clauses (key_field IN (...)) and
+    updated with one server side FeatureLayer.calculate call per batch. Everything calculate cannot
+    handle is sent as attribute-only edit_features updates.
+    Arguments:
+        feature_layer {FeatureLayer} -- the feature layer to update
+        updates {dict} -- a mapping {key: {field: new_value}}, e.g. {1: {"rating": "Good"}, 2: {"rating": "Good"}}
+    Keyword Arguments:
+        key_field {str} -- the field the keys refer to (default: {None} = the objectIdField of the layer)
+        batch_size {int} -- the maximum number of keys per request (default: {500})
+        use_calculate {bool} -- set to False to always use edit_features (default: {True})
+    Returns:
+        dict -- {'calculated': number of rows updated via calculate, 'edited': number of rows updated via edit_features, 'failed': list of keys that matched no row or could not be updated}
+        bool -- False if the update could not be started
+
+    Notes:
+        1. calculate is only used if the layer supports it (supportsCalculate) and it is not disabled
+        2. if key_field is not the objectIdField, the object ids are queried for the edit_features fallback
+        3. a key that matches several rows is reported as failed if any of its rows could not be updated
+    """
+    try:
+        properties = get_layer_definition(feature_layer)
+        oid_field = properties.get('objectIdField', 'OBJECTID')
+        key_field = key_field or oid_field
+        use_calculate = use_calculate and bool(properties.get('supportsCalculate', False))
+
+        # 1) group the keys by their new values
+        groups = {}
+        for key, attributes in updates.items():
+            group_key = tuple(sorted(attributes.items(), key=lambda item: item[0]))
+            groups.setdefault(group_key, []).append(key)
+
+        result = {'calculated': 0, 'edited': 0, 'failed': []}
+        fallback = []  # (key, attributes)
+        for group_key, keys in groups.items():
+            attributes = dict(group_key)
+            for i in range(0, len(keys), batch_size):
+                batch = keys[i:i + batch_size]
+                if(use_calculate):
+                    where = f"{key_field} IN ({','.join(_sql_literal(key) for key in batch)})"
+                    try:
+                        calc_result = feature_layer.calculate(where=where, calc_expression=_calc_expression(attributes))
+                    except Exception as e:
+                        print(e)
+                        calc_result = {}
+                    if(calc_result.get('success', False)):
+                        updated_count = calc_result.get('updatedFeatureCount', len(batch))
+                        result['calculated'] += updated_count
+                        # report the keys that matched no row, like the edit_features fallback does
+                        # (the row count only tells this if every key matches at most one row)
+                        if(key_field != oid_field or updated_count < len(batch)):
+                            try:
+                                features = feature_layer.query(where=where, out_fields=key_field, return_geometry=False).features
+                                found = {feature.attributes[key_field] for feature in features}
+                                result['failed'].extend(key for key in batch if key not in found)
+                            except Exception as e:
+                                print(e) # the batch is already updated, do not send it again
+                        continue
+                fallback.extend((key, attributes) for key in batch)
+
+        # 2) attribute-only edit_features for everything calculate did not handle
+        if(key_field == oid_field):
+            oid_updates = [(key, key, attributes) for key, attributes in fallback]  # (oid, key, attributes)
+        else:
+            oid_updates = []
+            for i in range(0, len(fallback), batch_size):
+                batch = dict(fallback[i:i + batch_size])
+                where = f"{key_field} IN ({','.join(_sql_literal(key) for key in batch)})"
+                try:
+                    features = feature_layer.query(where=where, out_fields=f"{oid_field},{key_field}", return_geometry=False).features
+                except Exception as e:
+                    print(e)
+                    result['failed'].extend(batch)
+                    continue
+                found = set()
+                for feature in features:
+                    key = feature.attributes[key_field]
+                    found.add(key)
+                    oid_updates.append((feature.attributes[oid_field], key, batch[key]))
+                result['failed'].extend(key for key in batch if key not in found)
+
+        for i in range(0, len(oid_updates), batch_size):
+            batch = oid_updates[i:i + batch_size]
+            edits = [{"attributes": {oid_field: oid, **attributes}} for oid, _, attributes in batch]
+            try:
+                edit_results = feature_layer.edit_features(updates=edits)["updateResults"]
+                # the update results are in the same order as the edits
+                result['edited'] += len([r for r in edit_results if r.get('success', False)])
+                result['failed'].extend(key for (_, key, _), r in zip(batch, edit_results) if not r.get('success', False))
+            except Exception as e:
+                print(e)
+                result['failed'].extend(key for _, key, _ in batch)
+        result['failed'] = list(dict.fromkeys(result['failed']))  # a key with several rows is reported once
+        return result
+    except Exception as e:
+        print(e)
+        return False
+
+def get_feature_layer(item_id:str=None, layer_name:str=None, layer_url:str=None, gis_portal: GIS = None) -> FeatureLayer | bool:
     """
     Get a feature layer from ArcGIS Online
     Arguments:
@@ -239,16 +361,20 @@ def get_feature_layer(item_id:str=None, layer_name:str=None, layer_url:str=None)
         or alternatively:
 
         layer_url {str} -- the explicit url of the layer
+    Keyword Arguments:
+        gis_portal {GIS} -- the gis portal to connect to (default: {None})
     Returns:
         FeatureLayer -- the feature layer
+
+    Notes:
+        1. item_id and layer_name are resolved with the shared (cached) LayerResolver,
+           repeated lookups do not send any requests
     """
     try: 
         if(layer_url != None and layer_url[-1].isdigit() == True):
             return FeatureLayer(layer_url)
         elif(item_id != None and layer_name != None):
-            item = portal.content.get(item_id)
-            feature_layer = [lyr for lyr in item.layers if lyr.properties.name == layer_name][0]
-            return feature_layer
+            return get_layer_resolver(gis_portal).get_feature_layer(item_id, layer_name)
         else:
             print('Please provide either a) item_id and layer_name or b) a layer_url')
             return False
@@ -312,6 +438,8 @@ def modify_fields_of_feature_layer(feature_layer:FeatureLayer, fields:list[dict]
     """
     try:
         results = feature_layer.manager.add_to_definition({"fields": fields})
+        if(results['success']):
+            get_layer_resolver(feature_layer._gis).invalidate(layer_url=feature_layer.url)
         return(results['success'])
     except Exception as e:
         print(e)
@@ -332,7 +460,7 @@ if __name__ == "__main__":
     if(EXAMPLE3):
         portal = authenticate()
 
-        fl = get_feature_layer(item_id='577bd8ec6ce24a4aabfcc5fd4aed13fe', layer_name='my_points')
+        fl = get_feature_layer(item_id='577bd8ec6ce24a4aabfcc5fd4aed13fe', layer_name='my_points', gis_portal=portal)
         additional_fields = [{  "name": "comment2",
                                 "type": "esriFieldTypeString",
                                 "alias": "comment2",